@@ -1,39 +1,63 @@
 import os
-from flask import Flask, request, jsonify, abort
+import random
+import time
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, abort
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from flask_caching import Cache
-from flask_jwt_extended import (
-    JWTManager,
-    get_jwt_identity,
-    jwt_required,
-    verify_jwt_in_request,
-)
-from werkzeug.utils import secure_filename
+from flask_jwt_extended import JWTManager, jwt_required
+from prometheus_client import Histogram
 from prometheus_flask_exporter import PrometheusMetrics
-from flasgger import Swagger
+from prometheus_flask_exporter.multiprocess import GunicornInternalPrometheusMetrics
+from flasgger import Swagger, swag_from
 from plantnet import PlantNetAPI
-from utils import allowed_file, get_logger
+from utils import (
+    OrjsonProvider,
+    cache_key,
+    get_logger,
+    parse_upload,
+    rate_limit_key,
+    validate_and_hash,
+)
 from config import Config
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Read once at import instead of going through app.config on every request.
+MAX_IMAGES = app.config["MAX_IMAGES"]
+MAX_IMAGE_SIZE = app.config["MAX_IMAGE_SIZE"]
+MAX_CONTENT_LENGTH = app.config["MAX_CONTENT_LENGTH"]
+ALLOWED_CONTENT_TYPES = frozenset(app.config["ALLOWED_CONTENT_TYPES"])
+CACHE_TIMEOUT = app.config["CACHE_DEFAULT_TIMEOUT"]
+METRICS_SAMPLE_RATE = app.config["METRICS_SAMPLE_RATE"]
+app.json = OrjsonProvider(app)
 
-limiter = Limiter(
-    key_func=lambda: (
-        get_jwt_identity()
-        if verify_jwt_in_request(optional=True)
-        else get_remote_address()
-    )
-)
+
+limiter = Limiter(key_func=rate_limit_key)
 limiter.init_app(app)
 
 cache = Cache(app)
 
 logger = get_logger(__name__)
 
-metrics = PrometheusMetrics(app)
+# Only the identify endpoint is instrumented; the default per-request
+# latency histogram for every route is turned off. Under Gunicorn the
+# metrics of all worker processes are aggregated from PROMETHEUS_MULTIPROC_DIR.
+if os.path.isdir(os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")):
+    metrics_class = GunicornInternalPrometheusMetrics
+else:
+    metrics_class = PrometheusMetrics
+metrics = metrics_class(app, export_defaults=False, defaults_prefix="plantid")
+metrics.info("plantid_app_info", "Plant Identification API", version="1.0.0")
+
+plantnet_latency = Histogram(
+    "plantid_plantnet_request_seconds",
+    f"Sampled ({METRICS_SAMPLE_RATE:.0%}) latency of PlantNet identification calls",
+)
+
+upload_pool = ThreadPoolExecutor(max_workers=MAX_IMAGES)
 
 plantnet_api = PlantNetAPI(
     app.config["PLANTNET_API_KEY"], app.config["PLANTNET_API_ENDPOINT"]
@@ -62,147 +86,66 @@ swagger = Swagger(app, template=swagger_template)
 jwt = JWTManager(app)
 
 
+@app.before_request
+def reject_oversized_body():
+    """
+    Reject requests that declare a body over MAX_CONTENT_LENGTH before any of
+    it is read.
+    """
+    if request.content_length and request.content_length > MAX_CONTENT_LENGTH:
+        abort(413, description="Request body too large")
+
+
 @app.route("/api/identify", methods=["POST"])
+@metrics.counter(
+    "plantid_identify_requests_total",
+    "Identification requests by response status",
+    labels={"status": lambda response: response.status_code},
+)
 @limiter.limit(app.config["RATELIMIT_DEFAULT"])
 @jwt_required()
+@swag_from("specs/identify_plant.yml")
 def identify_plant():
     """
     Identify plant species based on uploaded images.
+    """
+    images, organs = parse_upload(request, MAX_IMAGES, MAX_IMAGE_SIZE)
 
-    ---
-    parameters:
-      - name: image
-        in: formData
-        type: file
-        required: true
-        description: Image file(s) of the plant to be identified (up to 5 images).
-      - name: organ_1
-        in: formData
-        type: string
-        required: false
-        description: Organ of the plant in the first image.
-      - name: organ_2
-        in: formData
-        type: string
-        required: false
-        description: Organ of the plant in the second image.
-      - name: organ_3
-        in: formData
-        type: string
-        required: false
-        description: Organ of the plant in the third image.
-      - name: organ_4
-        in: formData
-        type: string
-        required: false
-        description: Organ of the plant in the fourth image.
-      - name: organ_5
-        in: formData
-        type: string
-        required: false
-        description: Organ of the plant in the fifth image.
-
-    responses:
-      200:
-        description: Successful plant identification.
-        schema:
-          $ref: '#/definitions/IdentificationResult'
-      400:
-        description: Bad request (missing or invalid parameters).
-      401:
-        description: Unauthorized (missing or invalid authentication token).
-      429:
-        description: Too many requests (rate limit exceeded).
-      500:
-        description: Internal server error.
-
-    definitions:
-      IdentificationResult:
-        type: object
-        properties:
-          results:
-            type: array
-            items:
-              $ref: '#/definitions/PlantMatch'
-      PlantMatch:
-        type: object
-        properties:
-          species:
-            type: object
-            properties:
-              scientificNameWithoutAuthor:
-                type: string
-              scientificNameAuthorship:
-                type: string
-              genus:
-                type: object
-                properties:
-                  scientificNameWithoutAuthor:
-                    type: string
-                  scientificNameAuthorship:
-                    type: string
-              family:
-                type: object
-                properties:
-                  scientificNameWithoutAuthor:
-                    type: string
-                  scientificNameAuthorship:
-                    type: string
-              commonNames:
-                type: array
-                items:
-                  type: string
-          score:
-            type: number
-    """
-    if "image" not in request.files:
+    if not images:
         abort(400, description="No image file found")
 
-    images = request.files.getlist("image")
-
-    if len(images) > app.config["MAX_IMAGES"]:
-        abort(
-            400,
-            description=f"You can upload up to {app.config['MAX_IMAGES']} images only",
-        )
-
-    for image_file in images:
-        if not allowed_file(image_file.filename):
-            abort(400, description="Invalid file extension")
-        if image_file.content_type not in app.config["ALLOWED_CONTENT_TYPES"]:
-            abort(400, description="Invalid file content type")
-
-    files = []
-    organs = []
-    for idx, image_file in enumerate(images):
-        organ = request.form.get(f"organ_{idx+1}", "auto")
-        organs.append(organ)
-        files.append(
-            (
-                "images",
-                (
-                    secure_filename(image_file.filename),
-                    image_file.stream,
-                    image_file.mimetype,
-                ),
-            )
-        )
-
-    data = {"organs": organs}
+    if len(images) > MAX_IMAGES:
+        abort(400, description=f"You can upload up to {MAX_IMAGES} images only")
+
+    futures = [
+        upload_pool.submit(validate_and_hash, upload, ALLOWED_CONTENT_TYPES)
+        for upload in images
+    ]
+
+    # Send each distinct image only once, with the organ of its first upload.
+    unique = {}
+    for future, organ in zip(futures, organs):
+        image, digest = future.result()
+        unique.setdefault(digest, (image, organ))
+    images = [image for image, _ in unique.values()]
+    organs = [organ for _, organ in unique.values()]
 
     try:
-        cache_key = f"identification_{hash(tuple(files))}"
-        cached_result = cache.get(cache_key)
+        key = cache_key(unique.keys(), organs)
+        cached_result = cache.get(key)
         if cached_result:
             logger.info("Returning cached identification result")
-            return jsonify(cached_result), 200
+            return Response(cached_result, mimetype="application/json"), 200
 
-        json_result = plantnet_api.identify(files, data)["results"][0]
+        started = time.perf_counter()
+        body = plantnet_api.identify(images, organs)
+        if random.random() < METRICS_SAMPLE_RATE:
+            plantnet_latency.observe(time.perf_counter() - started)
 
-        cache.set(cache_key, json_result, timeout=app.config["CACHE_DEFAULT_TIMEOUT"])
+        cache.set(key, body, timeout=CACHE_TIMEOUT)
 
         logger.info("Plant identification successful")
-        return jsonify(json_result), 200
+        return Response(body, mimetype="application/json"), 200
 
     except Exception as e:
         logger.exception("Error during plant identification")
@@ -233,12 +176,26 @@ def not_found(error):
     return jsonify({"error": "Not found"}), 404
 
 
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """
+    Custom error handler for 413 Payload Too Large.
+    """
+    return jsonify({"error": error.description}), 413
+
+
 @app.errorhandler(429)
 def rate_limit_exceeded(error):
     """
     Custom error handler for 429 Too Many Requests.
     """
-    return jsonify({"error": "Rate limit exceeded"}), 429
+    # Flask-Limiter sets Retry-After from the same limit as X-My-RateLimit-Reset.
+    return (
+        jsonify(
+            {"ok": False, "code": "agent.rate_limited", "message": "Rate limit exceeded"}
+        ),
+        429,
+    )
 
 
 @app.errorhandler(500)
@@ -249,5 +206,18 @@ def internal_server_error(error):
     return jsonify({"error": error.description}), 500
 
 
+with app.app_context():
+    APISPEC = orjson.dumps(swagger.get_apispecs())
+
+
+@app.route("/apispec_cached")
+def apispec_cached():
+    """
+    Serve the Swagger spec rendered once at startup.
+    """
+    return Response(APISPEC, mimetype="application/json")
+
+
 if __name__ == "__main__":
+    # Development server only; production runs under Gunicorn (gunicorn_conf.py).
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
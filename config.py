@@ -13,11 +13,18 @@ class Config:
     JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
     MAX_IMAGES = 5
     ALLOWED_CONTENT_TYPES = ["image/jpeg", "image/png"]
-    CACHE_TYPE = "simple"
-    CACHE_DEFAULT_TIMEOUT = 3600
+    MAX_IMAGE_SIZE = 8 * 1024 * 1024
+    # Headroom for part headers, boundaries and organ fields; UploadsTarget
+    # enforces MAX_IMAGE_SIZE per image exactly.
+    MAX_CONTENT_LENGTH = MAX_IMAGES * MAX_IMAGE_SIZE + 64 * 1024
+    CACHE_TYPE = "RedisCache"
+    CACHE_REDIS_URL = os.environ.get("REDIS_URL")
+    CACHE_KEY_PREFIX = "plantid:"
+    CACHE_DEFAULT_TIMEOUT = 86400
+    METRICS_SAMPLE_RATE = 0.1
     RATELIMIT_DEFAULT = "10/minute"
     RATELIMIT_STORAGE_URI=os.environ.get("REDIS_URL")
-    RATELIMIT_STRATEGY="fixed-window-elastic-expiry"
+    RATELIMIT_STRATEGY="sliding-window-counter"
     RATELIMIT_HEADERS_ENABLED=True
     RATELIMIT_HEADER_LIMIT="X-My-RateLimit-Limit"
     RATELIMIT_HEADER_REMAINING="X-My-RateLimit-Remaining"
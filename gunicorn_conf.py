@@ -0,0 +1,32 @@
+import glob
+import os
+
+# Workers write their metrics to files in this directory and /metrics
+# aggregates them. It must be set before prometheus_client is imported.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/plantid-metrics")
+
+from prometheus_client.multiprocess import mark_process_dead
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+# Threads in a worker share the PlantNet connection pool and upload pool.
+worker_class = "gthread"
+threads = 8
+timeout = 60
+keepalive = 15
+# The app starts background threads at import (log listener, upload pool),
+# so it must be loaded in each worker rather than preloaded before forking.
+preload_app = False
+
+
+def on_starting(server):
+    # Drop metric files left over from a previous run, leaving anything else
+    # in the directory (which may be a mounted volume) untouched.
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
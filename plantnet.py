@@ -1,14 +1,106 @@
+import os
+import ijson
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds for calls to PlantNet.
+TIMEOUT = (3.05, 30)
+
+
+class MultipartBody:
+    """
+    Read-only multipart/form-data body built from a list of segments. Image
+    parts are memoryviews over the upload buffers, so reads hand the image
+    bytes to the socket without copying them.
+    """
+
+    def __init__(self, organs, images):
+        boundary = os.urandom(16).hex()
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        segments = []
+        for organ in organs:
+            segments.append(
+                f"--{boundary}\r\n"
+                'Content-Disposition: form-data; name="organs"\r\n\r\n'
+                f"{organ}\r\n".encode()
+            )
+        for filename, stream, content_type in images:
+            segments.append(
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="images"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n".encode()
+            )
+            segments.append(stream.getbuffer())
+            segments.append(b"\r\n")
+        segments.append(f"--{boundary}--\r\n".encode())
+        self._segments = [memoryview(segment) for segment in segments]
+        self._length = sum(len(segment) for segment in self._segments)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            rest = [self._segments[self._index][self._offset :]]
+            rest += self._segments[self._index + 1 :]
+            self._index, self._offset = len(self._segments), 0
+            return b"".join(rest)
+        while self._index < len(self._segments):
+            segment = self._segments[self._index]
+            if self._offset < len(segment):
+                chunk = segment[self._offset : self._offset + size]
+                self._offset += len(chunk)
+                return chunk
+            self._index += 1
+            self._offset = 0
+        return b""
 
 
 class PlantNetAPI:
     def __init__(self, api_key, api_endpoint):
         self.api_key = api_key
         self.api_endpoint = api_endpoint
+        self.url = f"{api_endpoint}?include-related-images=false&no-reject=false&lang=fr&api-key={api_key}"
+        # One session per process so concurrent requests share a keep-alive
+        # connection pool instead of opening a new TLS connection per call.
+        # POST is not in Retry's default allowed_methods, so only connection
+        # errors are retried, before any of the streamed body has been sent.
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=64,
+                max_retries=Retry(total=2, backoff_factor=0.2),
+            ),
+        )
 
-    def identify(self, files, data):
-        response = requests.post(
-            f"{self.api_endpoint}?include-related-images=false&no-reject=false&lang=fr&api-key={self.api_key}", files=files, data=data
+    def identify(self, images, organs):
+        """
+        Send (filename, stream, content_type) images to PlantNet and return the
+        best match as JSON bytes. The request body is streamed from the upload
+        buffers, and only the first result of the reply is parsed.
+        """
+        body = MultipartBody(organs, images)
+        response = self.session.post(
+            self.url,
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=TIMEOUT,
+            stream=True,
         )
-        response.raise_for_status()
-        return response.json()
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            results = ijson.items(response.raw, "results.item", use_float=True)
+            best = next(results, None)
+        finally:
+            # Discard the unparsed rest so the connection returns to the pool.
+            response.raw.drain_conn()
+        if best is None:
+            raise ValueError("PlantNet returned no results")
+        return orjson.dumps(best)
@@ -1,21 +1,200 @@
+import atexit
 import logging
+import logging.handlers
+import queue
+import re
+from io import BytesIO
+import jwt
+import orjson
+from blake3 import blake3
+from flask import abort, request
+from flask.json.provider import JSONProvider
+from flask_limiter.util import get_remote_address
+from werkzeug.exceptions import BadRequest
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, ValueTarget
+from streaming_form_data.validators import MaxSizeValidator, ValidationError
 
+# Request threads only enqueue log records; a single background listener
+# formats them and writes to stderr.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+)
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
-def allowed_file(filename):
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in [
-        "jpg",
-        "jpeg",
-        "png",
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def safe_filename(filename):
+    """
+    Replace every character outside [A-Za-z0-9._-] in a client supplied
+    filename, dropping leading dots and capping its length.
+    """
+    return _UNSAFE_FILENAME_CHARS.sub("_", filename or "").lstrip(".")[:128] or "image"
+
+
+def rate_limit_key():
+    """
+    Rate limit bucket for the current request: one bucket per bearer token
+    (its subject plus the start of its signature), or the client address
+    when there is none. The token is only decoded, not verified;
+    @jwt_required() still verifies it on the route. Keying on the signature
+    means a forged token naming another user gets its own bucket instead of
+    draining theirs, at the cost of each token a user holds, including
+    refreshed ones, starting with a full quota.
+    """
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        token = auth[7:]
+        try:
+            subject = jwt.decode(token, options={"verify_signature": False}).get("sub")
+        except jwt.InvalidTokenError:
+            subject = None
+        if subject:
+            return f"{subject}:{token.rsplit('.', 1)[-1][:16]}"
+    return get_remote_address()
+
+
+def sniff_image(head):
+    """
+    Return the content type of an image from its first bytes, or None if it
+    is neither a JPEG nor a PNG.
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    return None
+
+
+# Organ values are short words such as "leaf" or "flower".
+MAX_ORGAN_SIZE = 64
+
+
+class ImageTooLarge(ValidationError):
+    pass
+
+
+class UploadsTarget(BaseTarget):
+    """
+    Collect every part sent under one field name as a (filename, stream)
+    tuple.
+    """
+
+    def __init__(self, max_size, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_size = max_size
+        self.uploads = []
+
+    def on_start(self):
+        self._buffer = BytesIO()
+
+    def on_data_received(self, chunk):
+        if self._buffer.tell() + len(chunk) > self.max_size:
+            raise ImageTooLarge(f"Part larger than {self.max_size} bytes")
+        self._buffer.write(chunk)
+
+    def on_finish(self):
+        self._buffer.seek(0)
+        self.uploads.append((self.multipart_filename, self._buffer))
+
+
+def parse_upload(request, max_images, max_image_size, chunk_size=64 * 1024):
+    """
+    Parse the multipart body straight from the request input stream, bypassing
+    Werkzeug's form parser. Returns the uploaded images and their organs.
+    Parsing stops as soon as one image grows past max_image_size.
+    """
+    images = UploadsTarget(max_image_size)
+    validators = [MaxSizeValidator(MAX_ORGAN_SIZE) for _ in range(max_images)]
+    organs = [ValueTarget(validator=validator) for validator in validators]
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register("image", images)
+        for idx, organ in enumerate(organs):
+            parser.register(f"organ_{idx+1}", organ)
+        while chunk := request.stream.read(chunk_size):
+            parser.data_received(chunk)
+    except ParseFailedException:
+        abort(400, description="Invalid multipart form data")
+    except ImageTooLarge:
+        limit = max_image_size // (1024 * 1024)
+        abort(413, description=f"Images must be at most {limit} MB each")
+    except ValidationError:
+        idx = next(
+            idx
+            for idx, validator in enumerate(validators)
+            if validator.so_far > validator.max_size
+        )
+        abort(
+            400,
+            description=f"organ_{idx+1} must be at most {MAX_ORGAN_SIZE} bytes",
+        )
+    return images.uploads, [
+        organ.value.decode(errors="replace") or "auto" for organ in organs
     ]
 
 
+def image_digest(stream):
+    """
+    Return the BLAKE3 digest of a buffered upload.
+    """
+    with stream.getbuffer() as view:
+        return blake3(view).digest()
+
+
+def validate_and_hash(upload, allowed_content_types):
+    """
+    Check that a parsed upload is an allowed image and hash it. Returns the
+    (filename, stream, content_type) image and its digest.
+    """
+    filename, stream = upload
+    content_type = sniff_image(stream.read(12))
+    stream.seek(0)
+    if content_type not in allowed_content_types:
+        raise BadRequest(description="Invalid file content type")
+    return (safe_filename(filename), stream, content_type), image_digest(stream)
+
+
+def cache_key(digests, organs):
+    """
+    Build a cache key from the digests of the uploaded images and their organs.
+    """
+    key = blake3(b"".join(digests))
+    key.update("\0".join(organs).encode())
+    return f"identification_{key.hexdigest()}"
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    JSON provider that serializes with orjson instead of the json module.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes to the response as-is instead of str round-tripping.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+            mimetype="application/json",
+        )
+
+
 def get_logger(name):
     logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
     logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
-    handler = logging.StreamHandler()
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logger.propagate = False
     return logger